@@ -1,24 +1,52 @@
-import base64
+import csv
 import os
 import re
+import shutil
+import threading
 import time
-from datetime import datetime, timedelta
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from io import StringIO
+from operator import itemgetter
+from zoneinfo import ZoneInfo
 import pandas as pd
-import pytz
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, render_template, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import orjson
+except ImportError:  # Fall back to requests' stdlib json parsing
+    orjson = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', os.urandom(24))
 
 # Constants
 GONG_BASE_URL = "https://us-11211.api.gong.io"
-SF_TZ = pytz.timezone('America/Los_Angeles')
+SF_TZ = ZoneInfo('America/Los_Angeles')
 OUTPUT_DIR = "/tmp/gong_output"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+RUN_RETENTION_SECONDS = 24 * 60 * 60
 BATCH_SIZE = 10
 TRANSCRIPT_BATCH_SIZE = 50
+FETCH_WORKERS = 3
+GONG_MAX_RETRIES = 3
+GONG_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+def web_concurrency():
+    """Gunicorn worker count from WEB_CONCURRENCY; missing or malformed values count as 1"""
+    try:
+        return max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
+
+# Gong allows 3 API calls per second per company; split that budget across gunicorn worker processes
+GONG_CALLS_PER_SECOND = 3 / web_concurrency()
 SHEET_ID = "1tvItwAqONZYhetTbg7KAHw0OMPaDfCoFC4g6rSg0QvE"
 
 # Product precedence order
@@ -39,8 +67,9 @@ PRODUCT_ABBREVIATIONS = {
     "eaas and savings measurement": "EaaS"
 }
 
-# Global variables for Google Sheets data
+# Global variables for Google Sheets data (product names are stored lowercase)
 PRODUCT_MAPPINGS = {}
+PRODUCT_REGEXES = {}
 TRACKER_MAPPINGS = {}
 TRACKER_TO_PRODUCT_MAPPINGS = {}
 CALL_ID_TO_ACCOUNT_NAME = {}
@@ -49,14 +78,37 @@ OWNER_ACCOUNT_NAMES = set()
 TARGET_DOMAINS = set()
 TENANT_DOMAINS = set()
 INTERNAL_DOMAINS = set()
+INTERNAL_DOMAIN_SUFFIXES = ()
 INTERNAL_SPEAKERS = set()
 EXCLUDED_DOMAINS = set()
 EXCLUDED_ACCOUNT_NAMES = set()
 ALWAYS_INCLUDE_DOMAINS = {}
 
+# Placeholder website values that mean "no domain"
+UNKNOWN_DOMAIN_VALUES = frozenset(["n/a", "unknown", ""])
+
+# Fixed patterns, compiled once at import
+URL_PREFIX_RE = re.compile(r'^(?:https?://)?(?:www\.)?')
+DIGITS_RE = re.compile(r'(\d+)')
+
+# CRM context fields read per call, as (object type, field name) in lowercase
+CONTEXT_FIELDS = frozenset([("account", "name"), ("account", "website"), ("account", "industry")])
+CONTEXT_OBJECT_TYPES = frozenset(object_type for object_type, _ in CONTEXT_FIELDS)
+
+# Speaker used for transcript monologues whose speakerId isn't in the call's parties
+UNKNOWN_SPEAKER = {"first_name": "Unknown", "affiliation": "E", "label": "Unknown [E]"}
+
+# Call summary CSV column order - Edit 6: Include new columns
+SUMMARY_COLUMNS = [
+    "call_id", "call_title", "call_date", "product_tags",
+    "org_type", "account_name", "account_website",
+    "account_industry", "transcript_bucket", "call_rank",
+    "call_summary"
+]
+
 def natural_sort_key(filename):
     """Helper function for natural sorting of filenames with numbers"""
-    parts = re.split(r'(\d+)', filename)
+    parts = DIGITS_RE.split(filename)
     return [int(part) if part.isdigit() else part.lower() for part in parts]
 
 # Add natural sort filter to Jinja2
@@ -74,16 +126,17 @@ def load_csv_from_sheet(gid):
         pass
     return pd.DataFrame()
 
+@lru_cache(maxsize=4096)
 def normalize_domain(url):
-    if not url or url.lower() in ["n/a", "unknown", ""]:
+    if not url or url.lower() in UNKNOWN_DOMAIN_VALUES:
         return "unknown"
     try:
-        domain = re.sub(r'^https?://', '', str(url).lower())
-        domain = re.sub(r'^www\.', '', domain)
+        domain = URL_PREFIX_RE.sub('', str(url).lower())
         return domain.split('/')[0].strip() or "unknown"
     except:
         return "unknown"
 
+@lru_cache(maxsize=4096)
 def get_email_domain(email):
     if not email or "@" not in email:
         return ""
@@ -92,74 +145,92 @@ def get_email_domain(email):
 def get_field(data, key, default=""):
     if not isinstance(data, dict):
         return default
-    return next((v if v is not None else default for k, v in data.items() if k.lower() == key.lower()), default)
-
-def extract_field_values(context, field_name, object_type=None):
-    values = []
+    # Gong returns the camelCase keys we ask for, so an exact hit skips the case-insensitive scan
+    if key in data:
+        value = data[key]
+        return value if value is not None else default
+    key_lower = key.lower()
+    return next((v if v is not None else default for k, v in data.items() if k.lower() == key_lower), default)
+
+def extract_context_fields(context):
+    """Walk CRM context once, collecting CONTEXT_FIELDS values keyed by (object type, field name) in lowercase"""
+    values = {}
     for ctx in context or []:
         for obj in ctx.get("objects", []):
-            if object_type and get_field(obj, "objectType", "").lower() != object_type.lower():
+            object_type = get_field(obj, "objectType", "").lower()
+            if object_type not in CONTEXT_OBJECT_TYPES:
                 continue
-            if field_name.lower() == "objectid":
-                if value := get_field(obj, "objectId", ""):
-                    values.append(str(value))
-            else:
-                for field in obj.get("fields", []):
-                    if isinstance(field, dict) and get_field(field, "name", "").lower() == field_name.lower():
-                        if value := get_field(field, "value", ""):
-                            values.append(str(value))
+            for field in obj.get("fields", []):
+                if not isinstance(field, dict):
+                    continue
+                key = (object_type, get_field(field, "name", "").lower())
+                if key in CONTEXT_FIELDS and (value := get_field(field, "value", "")):
+                    values.setdefault(key, []).append(str(value))
     return values
 
+def combine_patterns(patterns):
+    """Merge keyword patterns into one alternation so text is scanned once per product"""
+    # Merging renumbers capture groups, which would break numbered backreferences
+    if not all(p.groups == 0 for p in patterns):
+        return None
+    try:
+        return re.compile("|".join(f"(?:{p.pattern})" for p in patterns), re.IGNORECASE)
+    except re.error:
+        return None
+
+def matches_product_keywords(text, product):
+    if regex := PRODUCT_REGEXES.get(product):
+        return regex.search(text) is not None
+    # Keywords that can't be merged (e.g. inline flags, capture groups) are checked one by one
+    return any(pattern.search(text) for pattern in PRODUCT_MAPPINGS.get(product, []))
+
 # Load all Google Sheets data
 def initialize_data():
-    global PRODUCT_MAPPINGS, TRACKER_MAPPINGS, TRACKER_TO_PRODUCT_MAPPINGS
+    global PRODUCT_MAPPINGS, PRODUCT_REGEXES, TRACKER_MAPPINGS, TRACKER_TO_PRODUCT_MAPPINGS
     global CALL_ID_TO_ACCOUNT_NAME, ACCOUNT_NAME_MAPPINGS
     global OWNER_ACCOUNT_NAMES, TARGET_DOMAINS, TENANT_DOMAINS
-    global INTERNAL_DOMAINS, INTERNAL_SPEAKERS
+    global INTERNAL_DOMAINS, INTERNAL_DOMAIN_SUFFIXES, INTERNAL_SPEAKERS
     global EXCLUDED_DOMAINS, EXCLUDED_ACCOUNT_NAMES, ALWAYS_INCLUDE_DOMAINS
     
     # Product mappings
     df = load_csv_from_sheet(1216942066)
     if not df.empty and "Product" in df.columns and "Keyword" in df.columns:
-        for _, row in df.iterrows():
-            product = row.get("Product", "").lower()
-            keyword = row.get("Keyword", "")
+        rows = df[["Product", "Keyword"]].dropna().astype(str)
+        for product, keyword in zip(rows["Product"].str.lower(), rows["Keyword"]):
             if product and keyword:
                 PRODUCT_MAPPINGS.setdefault(product, []).append(re.compile(keyword, re.IGNORECASE))
+        for product, patterns in PRODUCT_MAPPINGS.items():
+            PRODUCT_REGEXES[product] = combine_patterns(patterns)
     
     # Tracker mappings
     df = load_csv_from_sheet(1601335672)
     if not df.empty and "Original Tracker" in df.columns and "Mapped Tracker" in df.columns:
-        for _, row in df.iterrows():
-            original = row.get("Original Tracker", "").lower()
-            mapped = row.get("Mapped Tracker", "").lower()
+        rows = df[["Original Tracker", "Mapped Tracker"]].dropna().astype(str)
+        for original, mapped in zip(rows["Original Tracker"].str.lower(), rows["Mapped Tracker"].str.lower()):
             if original and mapped:
                 TRACKER_MAPPINGS[original] = mapped
     
     # Tracker to product mappings
     df = load_csv_from_sheet(2037592660)
     if not df.empty and "Tracker" in df.columns and "Product" in df.columns:
-        for _, row in df.iterrows():
-            tracker = row.get("Tracker", "").lower()
-            product = row.get("Product", "").lower()
+        rows = df[["Tracker", "Product"]].dropna().astype(str)
+        for tracker, product in zip(rows["Tracker"].str.lower(), rows["Product"].str.lower()):
             if tracker and product:
                 TRACKER_TO_PRODUCT_MAPPINGS[tracker] = product
     
     # Call ID to account name
     df = load_csv_from_sheet(300481101)
     if not df.empty and "Call ID" in df.columns and "Account Name" in df.columns:
-        for _, row in df.iterrows():
-            call_id = str(row.get("Call ID", ""))
-            account_name = row.get("Account Name", "").lower()
+        rows = df[["Call ID", "Account Name"]].dropna().astype(str)
+        for call_id, account_name in zip(rows["Call ID"], rows["Account Name"].str.lower()):
             if call_id and account_name:
                 CALL_ID_TO_ACCOUNT_NAME[call_id] = account_name
     
     # Account name mappings
     df = load_csv_from_sheet(1023256128)
     if not df.empty and "Original Name" in df.columns and "Mapped Name" in df.columns:
-        for _, row in df.iterrows():
-            original = row.get("Original Name", "").lower()
-            mapped = row.get("Mapped Name", "").lower()
+        rows = df[["Original Name", "Mapped Name"]].dropna().astype(str)
+        for original, mapped in zip(rows["Original Name"].str.lower(), rows["Mapped Name"].str.lower()):
             if original and mapped:
                 ACCOUNT_NAME_MAPPINGS[original] = mapped
     
@@ -182,6 +253,7 @@ def initialize_data():
     df = load_csv_from_sheet(784372544)
     if not df.empty and "Domain" in df.columns:
         INTERNAL_DOMAINS.update(df["Domain"].dropna().astype(str).str.lower())
+        INTERNAL_DOMAIN_SUFFIXES = tuple("." + d for d in INTERNAL_DOMAINS)
     
     # Internal speakers
     df = load_csv_from_sheet(1402964429)
@@ -201,28 +273,70 @@ def initialize_data():
     # Always include domains
     df = load_csv_from_sheet(1463029381)
     if not df.empty and "Domain" in df.columns and "Product" in df.columns:
-        for _, row in df.iterrows():
-            domain = normalize_domain(row.get("Domain", ""))
-            product = row.get("Product", "").lower()
+        rows = df[["Domain", "Product"]].dropna().astype(str)
+        for domain, product in zip(rows["Domain"], rows["Product"].str.lower()):
+            domain = normalize_domain(domain)
             if domain and product:
                 ALWAYS_INCLUDE_DOMAINS.setdefault(domain, []).append(product)
 
 # Gong API Client
+class RateLimiter:
+    """Space calls evenly so all threads in this process stay under a calls-per-second limit"""
+    def __init__(self, calls_per_second):
+        self.interval = 1.0 / calls_per_second
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+# Shared by every client so concurrent runs in one worker process share the Gong budget
+GONG_RATE_LIMITER = RateLimiter(GONG_CALLS_PER_SECOND)
+
 class GongAPIClient:
     def __init__(self, access_key, secret_key):
         self.session = requests.Session()
-        credentials = base64.b64encode(f"{access_key}:{secret_key}".encode()).decode()
-        self.session.headers.update({"Authorization": f"Basic {credentials}"})
+        self.session.auth = (access_key, secret_key)
+        # Keep one warm keep-alive connection per concurrent fetch worker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=FETCH_WORKERS)
+        self.session.mount("https://", adapter)
+        # (endpoint, call_ids) for requests that still failed after retries
+        self.failed_requests = []
 
     def api_call(self, method, endpoint, **kwargs):
         # BUG FIX 1: Remove extra slash
         url = f"{GONG_BASE_URL}{endpoint}"  # Fixed: removed / between base URL and endpoint
-        try:
-            response = self.session.request(method, url, **kwargs, timeout=30)
-            if response.status_code == 200:
-                return response.json()
-        except:
-            pass
+        # Retry rate limits/server errors here rather than in urllib3 so every resend goes through
+        # the rate limiter (Gong's POST endpoints are read-only queries, so they're safe to resend)
+        for attempt in range(GONG_MAX_RETRIES + 1):
+            GONG_RATE_LIMITER.wait()
+            delay = 2 ** attempt
+            try:
+                response = self.session.request(method, url, **kwargs, timeout=30)
+                if response.status_code == 200:
+                    return orjson.loads(response.content) if orjson else response.json()
+                if response.status_code not in GONG_RETRY_STATUSES:
+                    print(f"Gong API {method} {endpoint} returned HTTP {response.status_code}")
+                    return None
+                error = f"returned HTTP {response.status_code}"
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = min(int(retry_after), 60)
+            except ValueError as e:
+                print(f"Gong API {method} {endpoint} returned invalid JSON: {str(e)}")
+                return None
+            except requests.RequestException as e:
+                error = f"failed: {str(e)}"
+            except Exception as e:
+                print(f"Gong API {method} {endpoint} failed: {str(e)}")
+                return None
+            if attempt < GONG_MAX_RETRIES:
+                time.sleep(delay)
+        print(f"Gong API {method} {endpoint} {error} after {GONG_MAX_RETRIES} retries")
         return None
 
     def fetch_call_list(self, from_date, to_date):
@@ -233,7 +347,8 @@ class GongAPIClient:
             if cursor:
                 params["cursor"] = cursor
             response = self.api_call("GET", "/v2/calls", params=params)
-            if not response:
+            if response is None:
+                self.failed_requests.append(("/v2/calls", []))
                 break
             for call in response.get("calls", []):
                 if call_id := call.get("id"):
@@ -265,7 +380,8 @@ class GongAPIClient:
                 "cursor": cursor
             }
             response = self.api_call("POST", "/v2/calls/extensive", json=data)
-            if not response:
+            if response is None:
+                self.failed_requests.append(("/v2/calls/extensive", call_ids))
                 break
             for call in response.get("calls", []):
                 yield call
@@ -279,35 +395,34 @@ class GongAPIClient:
         while True:
             data = {"filter": {"callIds": call_ids}, "cursor": cursor}
             response = self.api_call("POST", "/v2/calls/transcript", json=data)
-            if not response:
+            if response is None:
+                self.failed_requests.append(("/v2/calls/transcript", call_ids))
                 break
-            for t in response.get("callTranscripts", []):
-                if call_id := t.get("callId"):
-                    result[str(call_id)] = t.get("transcript", [])
+            result.update(
+                (str(t["callId"]), t.get("transcript", []))
+                for t in response.get("callTranscripts", []) if t.get("callId")
+            )
             cursor = response.get("records", {}).get("cursor")
             if not cursor:
                 break
         return result
 
-def convert_to_sf_time(utc_time):
-    if not utc_time:
-        return "N/A"
-    try:
-        utc_time = re.sub(r'\.\d+(?=[+-]\d{2}:\d{2})', '', utc_time.replace("Z", "+00:00"))
-        return datetime.fromisoformat(utc_time).astimezone(SF_TZ).strftime("%b %d, %Y")
-    except:
-        return "N/A"
+def convert_to_sf_dates(utc_times):
+    """Convert Gong UTC timestamps to SF calendar dates in one vectorized pass ("N/A" if unparseable)"""
+    dates = pd.to_datetime(pd.Series(utc_times, dtype="string"), utc=True, errors="coerce", format="ISO8601")
+    return dates.dt.tz_convert(SF_TZ).dt.strftime("%b %d, %Y").fillna("N/A").tolist()
 
-def check_product_keywords(call, patterns):
+def build_search_text(call):
+    """Flatten title, brief, outline, key points and highlights into one lowercase string"""
+    content = call.get("content", {})
+    
     # Extract and flatten outline - Edit 10: Enhanced outline processing
-    outline = get_field(call.get("content", {}), "outline", "")
+    outline = get_field(content, "outline", "")
     if isinstance(outline, list):
         outline_texts = []
         for item in outline:
             if isinstance(item, dict):
-                for key, value in item.items():
-                    if isinstance(value, str):
-                        outline_texts.append(value)
+                outline_texts.extend(value for value in item.values() if isinstance(value, str))
             elif isinstance(item, str):
                 outline_texts.append(item)
         outline = " ".join(outline_texts)
@@ -317,46 +432,54 @@ def check_product_keywords(call, patterns):
     # Check all content fields
     fields = [
         get_field(call.get("metaData", {}), "title", ""),
-        get_field(call.get("content", {}), "brief", ""),
+        get_field(content, "brief", ""),
         outline,
-        " ".join(kp.get("text", "") for kp in call.get("content", {}).get("keyPoints", [])),
-        " ".join(h.get("text", "") for h in call.get("content", {}).get("highlights", []))
+        " ".join([kp.get("text", "") for kp in content.get("keyPoints", [])]),
+        " ".join([h.get("text", "") for h in content.get("highlights", [])])
     ]
     
-    combined = " ".join(fields).lower()
-    return any(pattern.search(combined) for pattern in patterns)
+    return " ".join(fields).lower()
 
-def determine_products(call):
+def determine_products(call, search_text):
     products = []
     
     # Check content against product patterns
-    for product, patterns in PRODUCT_MAPPINGS.items():
-        if check_product_keywords(call, patterns):
+    for product in PRODUCT_MAPPINGS:
+        if matches_product_keywords(search_text, product):
             products.append(product)
     
-    # Check trackers
+    # Check trackers, once per distinct mapped name (dict keeps first-seen order)
+    tracker_names = {}
+    map_tracker = TRACKER_MAPPINGS.get
     for tracker in call.get("content", {}).get("trackers", []):
         tracker_name = get_field(tracker, "name", "").lower()
         # Apply tracker mapping
-        tracker_name = TRACKER_MAPPINGS.get(tracker_name, tracker_name)
-        
-        # Direct tracker to product mapping
-        if tracker_name in TRACKER_TO_PRODUCT_MAPPINGS:
-            product = TRACKER_TO_PRODUCT_MAPPINGS[tracker_name]
+        tracker_names[map_tracker(tracker_name, tracker_name)] = None
+    
+    for tracker_name in tracker_names:
+        for product in tracker_products(tracker_name):
             if product not in products:
                 products.append(product)
-        
-        # Check if tracker matches product patterns
-        for product, patterns in PRODUCT_MAPPINGS.items():
-            if any(pattern.search(tracker_name) for pattern in patterns):
-                if product not in products:
-                    products.append(product)
     
     return products
 
-def resolve_account_name(call):
-    context = call.get("context", [])
-    call_id = get_field(call.get("metaData", {}), "id", "")
+@lru_cache(maxsize=4096)
+def tracker_products(tracker_name):
+    """Products implied by a mapped tracker name; tracker vocabulary repeats across calls"""
+    products = []
+    
+    # Direct tracker to product mapping
+    if tracker_name in TRACKER_TO_PRODUCT_MAPPINGS:
+        products.append(TRACKER_TO_PRODUCT_MAPPINGS[tracker_name])
+    
+    # Check if tracker matches product patterns
+    for product in PRODUCT_MAPPINGS:
+        if product not in products and matches_product_keywords(tracker_name, product):
+            products.append(product)
+    
+    return tuple(products)
+
+def resolve_account_name(call, call_id, context_fields):
     call_id_clean = call_id.lstrip("'")
     
     # Check override first
@@ -364,28 +487,28 @@ def resolve_account_name(call):
         return CALL_ID_TO_ACCOUNT_NAME[call_id_clean]
     
     # Get from context
-    account_name = (extract_field_values(context, "name", "account") or [""])[0].lower()
+    account_name = context_fields.get(("account", "name"), [""])[0].lower()
     
     # Apply mapping
     account_name = ACCOUNT_NAME_MAPPINGS.get(account_name, account_name)
     
     # If no name, try website domain
     if not account_name:
-        website = (extract_field_values(context, "website", "account") or [""])[0]
+        website = context_fields.get(("account", "website"), [""])[0]
         if website:
             account_name = normalize_domain(website)
     
     # If still no name, infer from email domains
     if not account_name:
-        email_domains = []
+        email_domains = Counter()
         for party in call.get("parties", []):
             if email := get_field(party, "emailAddress", ""):
                 domain = get_email_domain(email)
                 if domain and domain not in INTERNAL_DOMAINS and domain not in EXCLUDED_DOMAINS:
-                    email_domains.append(domain)
+                    email_domains[domain] += 1
         if email_domains:
-            # Most common domain
-            account_name = max(set(email_domains), key=email_domains.count)
+            # Most common domain (ties go to the first one seen)
+            account_name = email_domains.most_common(1)[0][0]
     
     return account_name or "unknown"
 
@@ -399,30 +522,29 @@ def determine_org_type(account_name, account_website):
     else:
         return "tenant"  # Default
 
-def should_include_call(call_info, selected_products):
-    account_name = call_info["account_name"].lower()
-    account_domain = normalize_domain(call_info["account_website"])
-    selected_lower = [p.lower() for p in selected_products]
-    
+def is_excluded_call(account_name, parties):
     # Check exclusions
-    if account_name in EXCLUDED_ACCOUNT_NAMES:
-        return False
+    if account_name.lower() in EXCLUDED_ACCOUNT_NAMES:
+        return True
     
     # Check email domains for exclusions
-    for party in call_info["parties"]:
+    for party in parties:
         if email := get_field(party, "emailAddress", ""):
             if get_email_domain(email) in EXCLUDED_DOMAINS:
-                return False
+                return True
+    
+    return False
+
+def should_include_call(call_info, selected_set):
+    account_domain = normalize_domain(call_info["account_website"])
     
     # Check if call has selected products
-    call_products = [p.lower() for p in call_info["products"]]
-    if any(p in selected_lower for p in call_products):
+    if not selected_set.isdisjoint(call_info["products"]):
         return True
     
     # Check always include domains
     if account_domain in ALWAYS_INCLUDE_DOMAINS:
-        domain_products = ALWAYS_INCLUDE_DOMAINS[account_domain]
-        if any(p in selected_lower for p in domain_products):
+        if not selected_set.isdisjoint(ALWAYS_INCLUDE_DOMAINS[account_domain]):
             return True
     
     return False
@@ -442,11 +564,16 @@ def is_internal_speaker(party):
         if domain in INTERNAL_DOMAINS:
             return True
         # Subdomain match
-        if any(domain.endswith("." + d) for d in INTERNAL_DOMAINS):
+        if domain.endswith(INTERNAL_DOMAIN_SUFFIXES):
             return True
     
     return False
 
+def join_speaker_sentences(sentences, speaker):
+    text = " ".join(sentences)
+    # Edit 8: External speakers in ALL CAPS
+    return text if speaker['affiliation'] == "I" else text.upper()
+
 def format_transcript(call_data, transcript_data, product=None):
     # Build speaker lookup
     speakers = {}
@@ -461,9 +588,11 @@ def format_transcript(call_data, transcript_data, product=None):
         title = get_field(party, "title", "")
         affiliation = "I" if is_internal_speaker(party) else "E"
         
+        first_name = name.split(maxsplit=1)[0] if name and " " in name else name or "Unknown"
         speakers[speaker_id] = {
-            "first_name": name.split()[0] if name and " " in name else name or "Unknown",
-            "affiliation": affiliation
+            "first_name": first_name,
+            "affiliation": affiliation,
+            "label": f"{first_name} [{affiliation}]"
         }
         
         line = f"{name} [{affiliation}]"
@@ -473,18 +602,19 @@ def format_transcript(call_data, transcript_data, product=None):
     
     # Get EaaS patterns if processing EaaS product
     eaas_patterns = []
-    if product and product.lower() == "eaas and savings measurement":
+    if product == "eaas and savings measurement":
         eaas_patterns = PRODUCT_MAPPINGS.get("eaas and savings measurement", [])
     
     # Group consecutive sentences from same speaker
     transcript_lines = []
     current_speaker = None
+    current_speaker_info = UNKNOWN_SPEAKER
     current_sentences = []
     current_time_ms = 0
     
     for mono in transcript_data:
         speaker_id = mono.get("speakerId", "")
-        speaker = speakers.get(speaker_id, {"first_name": "Unknown", "affiliation": "E"})
+        speaker = speakers.get(speaker_id, UNKNOWN_SPEAKER)
         
         for sentence in mono.get("sentences", []):
             ms = sentence.get("start", 0)
@@ -498,10 +628,6 @@ def format_transcript(call_data, transcript_data, product=None):
                             matched_text = match.group()
                             text = f"[ENERGY_SAVINGS: {matched_text}] {text}"
                             break
-                
-                # Edit 8: External speakers in ALL CAPS
-                if speaker['affiliation'] != "I":
-                    text = text.upper()
             
             # If speaker changed or this is the first sentence
             if current_speaker != speaker_id or not current_sentences:
@@ -509,14 +635,14 @@ def format_transcript(call_data, transcript_data, product=None):
                 if current_sentences:
                     minutes = current_time_ms // 60000
                     seconds = (current_time_ms % 60000) // 1000
-                    prev_speaker = speakers.get(current_speaker, {"first_name": "Unknown", "affiliation": "E"})
                     
-                    transcript_lines.append(f"{minutes}:{seconds:02d} | {prev_speaker['first_name']} [{prev_speaker['affiliation']}]")
-                    transcript_lines.append(" ".join(current_sentences))
+                    transcript_lines.append(f"{minutes}:{seconds:02d} | {current_speaker_info['label']}")
+                    transcript_lines.append(join_speaker_sentences(current_sentences, current_speaker_info))
                     transcript_lines.append("")
                 
                 # Start new speaker group
                 current_speaker = speaker_id
+                current_speaker_info = speaker
                 current_sentences = [text] if text else []
                 current_time_ms = ms
             else:
@@ -528,60 +654,33 @@ def format_transcript(call_data, transcript_data, product=None):
     if current_sentences:
         minutes = current_time_ms // 60000
         seconds = (current_time_ms % 60000) // 1000
-        speaker = speakers.get(current_speaker, {"first_name": "Unknown", "affiliation": "E"})
         
-        transcript_lines.append(f"{minutes}:{seconds:02d} | {speaker['first_name']} [{speaker['affiliation']}]")
-        transcript_lines.append(" ".join(current_sentences))
+        transcript_lines.append(f"{minutes}:{seconds:02d} | {current_speaker_info['label']}")
+        transcript_lines.append(join_speaker_sentences(current_sentences, current_speaker_info))
         transcript_lines.append("")
     
     return speaker_lines, transcript_lines
 
-def assign_to_product(products, selected_products):
+def assign_to_product(products, selected_set):
     # Filter precedence to only selected products, maintaining original order
-    selected_lower = [p.lower() for p in selected_products]
-    active_precedence = [p for p in PRODUCT_PRECEDENCE if p in selected_lower]
+    active_precedence = [p for p in PRODUCT_PRECEDENCE if p in selected_set]
     
     # Find first product in active precedence that matches call's products
     for product in active_precedence:
-        if product in [p.lower() for p in products]:
+        if product in products:
             return product
     return None
 
-def calculate_ranking_score(call, product):
+def calculate_ranking_score(call, search_text, product):
     """Calculate ranking score based on keyword matches - Edit 5"""
-    patterns = PRODUCT_MAPPINGS.get(product.lower(), [])
+    patterns = PRODUCT_MAPPINGS.get(product, [])
     if not patterns:
         return 0
     
-    # Extract and flatten outline with enhanced processing
-    outline = get_field(call.get("content", {}), "outline", "")
-    if isinstance(outline, list):
-        outline_texts = []
-        for item in outline:
-            if isinstance(item, dict):
-                for key, value in item.items():
-                    if isinstance(value, str):
-                        outline_texts.append(value)
-            elif isinstance(item, str):
-                outline_texts.append(item)
-        outline = " ".join(outline_texts)
-    elif not isinstance(outline, str):
-        outline = ""
-    
-    # Combine all searchable text
-    fields = [
-        get_field(call.get("metaData", {}), "title", ""),
-        get_field(call.get("content", {}), "brief", ""),
-        outline,
-        " ".join(kp.get("text", "") for kp in call.get("content", {}).get("keyPoints", [])),
-        " ".join(h.get("text", "") for h in call.get("content", {}).get("highlights", []))
-    ]
-    combined_text = " ".join(fields).lower()
-    
     # Count matches
     score = 0
     for pattern in patterns:
-        matches = pattern.findall(combined_text)
+        matches = pattern.findall(search_text)
         score += len(matches)
     
     # Owner bonus
@@ -592,23 +691,34 @@ def calculate_ranking_score(call, product):
 
 def process_calls(calls, transcripts, selected_products):
     calls_by_product = {p.lower(): [] for p in selected_products}
-    summaries = []
+    selected_set = frozenset(calls_by_product)
     
     for call in calls:
         # Extract basic info
         meta = call.get("metaData", {})
-        context = call.get("context", [])
         call_id = get_field(meta, "id", "")
         
         if not call_id:
             continue
         
+        # Calls without a transcript never reach a transcript file or the summary
+        transcript = transcripts.get(call_id)
+        if not transcript:
+            continue
+        
         # Get call details
-        account_name = resolve_account_name(call)
-        account_website = (extract_field_values(context, "website", "account") or [""])[0]
-        account_industry = (extract_field_values(context, "industry", "account") or [""])[0]
+        context_fields = extract_context_fields(call.get("context", []))
+        account_name = resolve_account_name(call, call_id, context_fields)
+        
+        # Drop excluded accounts before the product keyword scan
+        if is_excluded_call(account_name, call.get("parties", [])):
+            continue
+        
+        account_website = context_fields.get(("account", "website"), [""])[0]
+        account_industry = context_fields.get(("account", "industry"), [""])[0]
         org_type = determine_org_type(account_name, account_website)
-        products = determine_products(call)
+        search_text = build_search_text(call)
+        products = determine_products(call, search_text)
         
         # Store org_type in call for ranking calculation
         call['org_type'] = org_type
@@ -616,7 +726,7 @@ def process_calls(calls, transcripts, selected_products):
         call_info = {
             "call_id": f"'{call_id}",
             "title": get_field(meta, "title", ""),
-            "date": convert_to_sf_time(get_field(meta, "started")),
+            "started": get_field(meta, "started"),
             "account_name": account_name,
             "account_website": account_website,
             "account_industry": account_industry,
@@ -628,64 +738,83 @@ def process_calls(calls, transcripts, selected_products):
         }
         
         # Check if we should include
-        if not should_include_call(call_info, selected_products):
+        if not should_include_call(call_info, selected_set):
             continue
         
-        # Process transcript
-        if transcript := transcripts.get(call_id):
-            # Assign to product file using dynamic precedence
-            if product := assign_to_product(call_info["products"], selected_products):
-                # Check if user selected this product
-                if product in [p.lower() for p in selected_products]:
-                    # Format transcript with product for EaaS tagging
-                    speaker_lines, transcript_lines = format_transcript(call_info, transcript, product)
-                    
-                    calls_by_product[product].append({
-                        "call_id": call_info["call_id"],
-                        "date": call_info["date"],
-                        "account_name": call_info["account_name"],
-                        "account_website": call_info["account_website"],
-                        "account_industry": call_info["account_industry"],
-                        "org_type": call_info["org_type"],
-                        "products": call_info["products"],
-                        "speakers": speaker_lines,
-                        "transcript": transcript_lines,
-                        "call": call,  # Store original call object for ranking
-                        "assigned_product": product
-                    })
+        # Assign to product file using dynamic precedence
+        if product := assign_to_product(call_info["products"], selected_set):
+            # Format transcript with product for EaaS tagging
+            speaker_lines, transcript_lines = format_transcript(call_info, transcript, product)
+            
+            calls_by_product[product].append({
+                "call_id": call_info["call_id"],
+                "started": call_info["started"],
+                "account_name": call_info["account_name"],
+                "account_website": call_info["account_website"],
+                "account_industry": call_info["account_industry"],
+                "org_type": call_info["org_type"],
+                "products": call_info["products"],
+                "speakers": speaker_lines,
+                "transcript": transcript_lines,
+                "call": call,  # Store original call object for ranking
+                "search_text": search_text,
+                "assigned_product": product
+            })
+    
+    # Convert call dates for every included call at once
+    included_calls = [call_data for product_calls in calls_by_product.values() for call_data in product_calls]
+    dates = convert_to_sf_dates([call_data["started"] for call_data in included_calls])
+    for call_data, date in zip(included_calls, dates):
+        call_data["date"] = date
     
     # Edit 5: Rank calls within each product
     for product, product_calls in calls_by_product.items():
         if product_calls:
             # Calculate scores
             for call_data in product_calls:
-                call_data["score"] = calculate_ranking_score(call_data["call"], product)
+                call_data["score"] = calculate_ranking_score(call_data["call"], call_data["search_text"], product)
             
             # Sort by score (descending) and assign ranks
-            product_calls.sort(key=lambda x: x["score"], reverse=True)
+            product_calls.sort(key=itemgetter("score"), reverse=True)
             for i, call_data in enumerate(product_calls):
                 call_data["rank"] = i + 1
     
-    # Generate summaries with ranking info - FIXED: Removed duplicate for loop
+    return calls_by_product
+
+def iter_summary_rows(calls_by_product):
+    """Yield one call-summary CSV row per ranked call, in SUMMARY_COLUMNS order"""
     for product, product_calls in calls_by_product.items():
         for call_data in product_calls:
-            summaries.append({
-                "call_id": call_data["call_id"],
-                "call_title": get_field(call_data["call"].get("metaData", {}), "title", ""),
-                "call_date": call_data["date"],
-                "product_tags": "|".join(call_data["products"]),
-                "org_type": call_data["org_type"],
-                "account_name": call_data["account_name"],
-                "account_website": call_data["account_website"],
-                "account_industry": call_data["account_industry"],
-                "transcript_bucket": call_data["assigned_product"],  # Edit 6
-                "call_rank": call_data["rank"],  # Edit 6
-                "call_summary": get_field(call_data["call"].get("content", {}), "brief", "")
-            })
-    
-    return calls_by_product, summaries
+            yield (
+                call_data["call_id"],
+                get_field(call_data["call"].get("metaData", {}), "title", ""),
+                call_data["date"],
+                "|".join(call_data["products"]),
+                call_data["org_type"],
+                call_data["account_name"],
+                call_data["account_website"],
+                call_data["account_industry"],
+                call_data["assigned_product"],  # Edit 6
+                call_data["rank"],  # Edit 6
+                get_field(call_data["call"].get("content", {}), "brief", "")
+            )
+
+def prune_old_runs():
+    """Delete per-run output directories older than RUN_RETENTION_SECONDS"""
+    cutoff = time.time() - RUN_RETENTION_SECONDS
+    try:
+        entries = list(os.scandir(OUTPUT_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        # Another worker thread may have removed the same expired directory already
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
 
-def generate_files(calls_by_product, summaries, start_date, end_date):
+def generate_files(calls_by_product, start_date, end_date, output_dir):
     files = []
     
     # Generate transcript files - UPDATED: Split into buckets of 5 instead of 10
@@ -693,9 +822,7 @@ def generate_files(calls_by_product, summaries, start_date, end_date):
         if not calls:
             continue
         
-        # Sort by rank (already done in process_calls)
-        calls.sort(key=lambda x: x["rank"])
-        
+        # Calls are already in rank order from process_calls
         # Split into buckets of 5 (CHANGED FROM 10)
         for bucket_idx, i in enumerate(range(0, len(calls), 5)):
             bucket_calls = calls[i:i+5]  # CHANGED FROM 10 to 5
@@ -703,7 +830,7 @@ def generate_files(calls_by_product, summaries, start_date, end_date):
             # Generate filename with abbreviation and rank
             abbrev = PRODUCT_ABBREVIATIONS.get(product, product[:3].upper())
             filename = f"{abbrev}_rank_{bucket_idx + 1}.txt"
-            filepath = os.path.join(OUTPUT_DIR, filename)
+            filepath = os.path.join(output_dir, filename)
             
             try:
                 with open(filepath, 'w', encoding='utf-8') as f:
@@ -729,12 +856,12 @@ def generate_files(calls_by_product, summaries, start_date, end_date):
                         f.write(f"ORG TYPE: {call['org_type']}\n")
                         f.write(f"PRODUCTS: {', '.join(call['products'])}\n\n")
                         f.write("SPEAKERS:\n")
-                        for speaker in call['speakers']:
-                            f.write(f"{speaker}\n")
+                        if call['speakers']:
+                            f.write("\n".join(call['speakers']) + "\n")
                         f.write("---\n\n")
                         
-                        for line in call['transcript']:
-                            f.write(f"{line}\n")
+                        if call['transcript']:
+                            f.write("\n".join(call['transcript']) + "\n")
                 
                 files.append((product, filename))
             except Exception as e:
@@ -743,28 +870,13 @@ def generate_files(calls_by_product, summaries, start_date, end_date):
     
     # Generate CSV - Edit 6: Include new columns
     csv_filename = f"call-summary_{start_date}_{end_date}.csv"
-    csv_path = os.path.join(OUTPUT_DIR, csv_filename)
+    csv_path = os.path.join(output_dir, csv_filename)
     
     try:
-        if summaries:
-            df = pd.DataFrame(summaries)
-            # Ensure correct column order
-            columns = [
-                "call_id", "call_title", "call_date", "product_tags",
-                "org_type", "account_name", "account_website", 
-                "account_industry", "transcript_bucket", "call_rank", 
-                "call_summary"
-            ]
-            df = df[columns]
-            df.to_csv(csv_path, index=False)
-        else:
-            # Empty CSV with headers
-            pd.DataFrame(columns=[
-                "call_id", "call_title", "call_date", "product_tags",
-                "org_type", "account_name", "account_website", 
-                "account_industry", "transcript_bucket", "call_rank",
-                "call_summary"
-            ]).to_csv(csv_path, index=False)
+        with open(csv_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(SUMMARY_COLUMNS)
+            writer.writerows(iter_summary_rows(calls_by_product))
         
         files.append(("summary", csv_filename))
     except Exception as e:
@@ -794,57 +906,77 @@ def process():
             return render_template('index.html', error="Please fill all fields and select at least one product")
         
         # Parse dates
-        start_dt = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=pytz.UTC)
-        end_dt = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=pytz.UTC)
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        end_dt = datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.utc)
         
         # BUG FIX 5: Add date range validation (6 months max)
         date_diff = end_dt - start_dt
         if date_diff.days > 180:  # 6 months = ~180 days
             return render_template('index.html', error="Date range cannot exceed 6 months. Please select a shorter range.")
         
+        # Clear out expired runs up front so cleanup can never cost a finished run
+        prune_old_runs()
+        
         # Initialize API client
         client = GongAPIClient(access_key, secret_key)
         
         # Fetch call IDs
         call_ids = client.fetch_call_list(start_dt.isoformat(), end_dt.isoformat())
         if not call_ids:
+            if client.failed_requests:
+                return render_template('index.html', error="Could not list calls from Gong. Please try again in a minute.")
             return render_template('index.html', error="No calls found in the selected date range")
         
-        # Fetch transcripts in batches
+        # Fetch transcripts and call details through one pool so both endpoints overlap
+        # (map submits every batch up front and yields results in the original call order)
         all_transcripts = {}
-        for i in range(0, len(call_ids), TRANSCRIPT_BATCH_SIZE):
-            batch = call_ids[i:i + TRANSCRIPT_BATCH_SIZE]
-            transcripts = client.fetch_transcript(batch)
-            if transcripts:
-                all_transcripts.update(transcripts)
-        
-        # Fetch call details in batches
         all_calls = []
-        for i in range(0, len(call_ids), BATCH_SIZE):
-            batch = call_ids[i:i + BATCH_SIZE]
-            for call in client.fetch_call_details(batch):
-                if call:
-                    all_calls.append(call)
+        transcript_batches = [call_ids[i:i + TRANSCRIPT_BATCH_SIZE] for i in range(0, len(call_ids), TRANSCRIPT_BATCH_SIZE)]
+        detail_batches = [call_ids[i:i + BATCH_SIZE] for i in range(0, len(call_ids), BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            transcript_results = executor.map(client.fetch_transcript, transcript_batches)
+            detail_results = executor.map(lambda batch: list(client.fetch_call_details(batch)), detail_batches)
+            for transcripts in transcript_results:
+                if transcripts:
+                    all_transcripts.update(transcripts)
+            for calls in detail_results:
+                all_calls.extend(call for call in calls if call)
         
         # Process calls
-        calls_by_product, summaries = process_calls(all_calls, all_transcripts, selected_products)
+        calls_by_product = process_calls(all_calls, all_transcripts, selected_products)
+        
+        # Generate files in a directory of their own so concurrent runs can't overwrite each other
+        run_id = uuid.uuid4().hex
+        output_dir = os.path.join(OUTPUT_DIR, run_id)
+        os.makedirs(output_dir)
+        files = generate_files(calls_by_product, start_date, end_date, output_dir)
         
-        # Generate files
-        files = generate_files(calls_by_product, summaries, start_date, end_date)
+        # Report requests Gong still refused after retries rather than silently dropping their calls
+        warnings = []
+        if any(endpoint == "/v2/calls" for endpoint, _ in client.failed_requests):
+            warnings.append("Gong stopped returning the call list partway, so some calls in this date range were never fetched.")
+        batch_failures = [ids for endpoint, ids in client.failed_requests if endpoint != "/v2/calls"]
+        if batch_failures:
+            missing_ids = {call_id for ids in batch_failures for call_id in ids}
+            warnings.append(f"{len(batch_failures)} Gong detail/transcript request(s) failed after retries; "
+                            f"up to {len(missing_ids)} calls may be missing from these results.")
+        warning = " ".join(warnings) or None
         
         return render_template('index.html', 
             success=True,
+            warning=warning,
+            run_id=run_id,
             files=files,
-            total_calls=len(summaries)
+            total_calls=sum(len(calls) for calls in calls_by_product.values())
         )
         
     except Exception as e:
         return render_template('index.html', error=f"Error: {str(e)}")
 
-@app.route('/download/<filename>')
-def download(filename):
-    filepath = os.path.join(OUTPUT_DIR, filename)
-    if os.path.exists(filepath):
+@app.route('/download/<run_id>/<filename>')
+def download(run_id, filename):
+    filepath = safe_join(OUTPUT_DIR, run_id, filename)
+    if filepath and os.path.isfile(filepath):
         return send_file(filepath, as_attachment=True)
     return "File not found", 404
 
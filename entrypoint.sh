@@ -1,3 +1,7 @@
 #!/bin/sh
 PORT=${PORT:-10000}
-exec gunicorn --bind 0.0.0.0:$PORT --timeout 120 app:app
+# app.py reads WEB_CONCURRENCY to split Gong's rate limit across workers
+export WEB_CONCURRENCY=${WEB_CONCURRENCY:-2}
+exec gunicorn --bind 0.0.0.0:$PORT --timeout 120 --preload \
+    --worker-class gthread --workers $WEB_CONCURRENCY --threads ${GUNICORN_THREADS:-4} \
+    app:app